@@ -1,6 +1,7 @@
 import pymysql
 import os
-import openai
+import asyncio
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 import json
@@ -10,6 +11,10 @@ import re
 from decimal import Decimal
 from datetime import datetime
 import argparse
+import functools
+from types import MappingProxyType
+import diskcache
+from openai import OpenAI, AsyncOpenAI
 
 # 환경 변수 로드
 load_dotenv()
@@ -31,11 +36,28 @@ if missing_vars:
     logger.error(f"Missing environment variables: {', '.join(missing_vars)}")
     raise EnvironmentError("필수 환경 변수가 설정되지 않았습니다.")
 
-# OpenAI API 키 설정
-openai.api_key = os.getenv('OPENAI_API_KEY')
+# OpenAI 클라이언트 설정
+client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-# 데이터베이스 연결 정보 가져오기
-db_config = {
+# 카테고리 분류 동시 요청 수 제한
+CATEGORIZE_CONCURRENCY = 5
+CATEGORIZE_MAX_RETRIES = 3
+CATEGORIZE_TOKENS_PER_ITEM = 40
+
+# 상품 카테고리 (분류되지 않은 상품은 '미분류')
+CATEGORIES = ['식품', '생활용품', '주류', '외식', '기타']
+VALID_CATEGORIES = frozenset(CATEGORIES)
+CATEGORY_DTYPE = pd.CategoricalDtype(categories=CATEGORIES + ['미분류'])
+
+# 분석 응답에서 JSON 블록 추출용 정규식
+JSON_BLOCK_RE = re.compile(r'```json\s*(\{.*?\})\s*```', re.DOTALL)
+JSON_FALLBACK_RE = re.compile(r'(\{.*?\})', re.DOTALL)
+
+# 상품명 -> 카테고리 캐시 (실행 간 유지)
+category_cache = diskcache.Cache(os.getenv('CATEGORY_CACHE_DIR', '.cache/categories'))
+
+# 데이터베이스 연결 정보 가져오기 (실수로 변경되지 않도록 읽기 전용)
+db_config = MappingProxyType({
     'host': os.getenv('DB_HOST'),
     'user': os.getenv('DB_USER'),
     'password': os.getenv('DB_PASSWORD'),
@@ -43,23 +65,27 @@ db_config = {
     'port': int(os.getenv('DB_PORT', 3306)),
     'charset': 'utf8mb4',
     'cursorclass': pymysql.cursors.DictCursor
-}
+})
+_connect = functools.partial(pymysql.connect, **db_config)
 
 def fetch_spending_data(user_id, month):
-    """특정 user_id와 월의 지출 데이터 로드"""
+    """특정 user_id와 월의 지출 데이터를 상품명별 합계로 로드"""
     
     logger.debug(f"Fetching spending data for user_id={user_id}, month={month}")
+    # 집계는 DB에서 수행하여 전송 행 수를 줄임 (spending(user_id, date) 인덱스 사용)
     sql = """
-        SELECT id, description, amount
+        SELECT description, SUM(amount) AS amount, COUNT(*) AS n
         FROM spending
         WHERE user_id = %s AND MONTH(date) = %s
+        GROUP BY description
     """
     try:
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
+        # 행마다 dict를 만들지 않도록 튜플 커서로 읽고, Decimal 금액은 float64로 변환
+        with _connect() as conn:
+            with conn.cursor(pymysql.cursors.Cursor) as cursor:
                 cursor.execute(sql, (user_id, month))
-                results = cursor.fetchall()
-        df = pd.DataFrame(results)
+                columns = [col[0] for col in cursor.description]
+                df = pd.DataFrame.from_records(cursor.fetchall(), columns=columns, coerce_float=True)
         logger.info("Successfully fetched spending data.")
         return df
     except pymysql.MySQLError as e:
@@ -76,87 +102,157 @@ def fetch_monthly_goal(user_id):
         WHERE user_id = %s
     """
     try:
-        with pymysql.connect(**db_config) as connection:
-            with connection.cursor() as cursor:
+        with _connect() as conn:
+            with conn.cursor() as cursor:
                 cursor.execute(sql, (user_id,))
                 result = cursor.fetchone()
         if result:
             logger.info(f"Monthly goal for user_id={user_id}: {result['monthly_goal']}원")
-            return Decimal(result['monthly_goal'])
+            monthly_goal = Decimal(result['monthly_goal'])
         else:
             logger.warning(f"No monthly goal found for user_id={user_id}.")
-            return Decimal('0.00')
+            monthly_goal = Decimal('0.00')
     except pymysql.MySQLError as e:
         logger.error(f"Error fetching monthly goal: {e}", exc_info=True)
         raise
 
-def categorize_products(product_names, batch_size=20):
-    """상품명을 카테고리별로 분류"""
+    return monthly_goal
+
+def _category_cache_key(name):
+    """공백과 대소문자 차이를 무시하는 캐시 키 생성"""
+    return name.strip().lower()
+
+async def _classify_batch(async_client, semaphore, batch):
+    """상품명 배치 하나를 OpenAI API로 분류 요청 후 분류 항목 리스트 반환"""
+
+    prompt = (
+        "각 상품명을 '식품', '생활용품', '주류', '외식', '기타' 중 하나로 분류하여 "
+        "{\"items\": [{\"name\": 상품명, \"category\": 카테고리}]} 형식의 JSON으로만 응답해주세요.\n\n"
+    )
+    prompt += "\n".join(batch)
+
+    async with semaphore:
+        response = await async_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": "당신은 유용한 카테고리 분류 도우미입니다."},
+                {"role": "user", "content": prompt}
+            ],
+            response_format={"type": "json_object"},
+            max_tokens=CATEGORIZE_TOKENS_PER_ITEM * len(batch),
+            temperature=0
+        )
+    response_content = response.choices[0].message.content.strip()
+    logger.debug(f"Categorization response: {response_content}")
+    return json.loads(response_content)['items']
+
+async def categorize_products(unique_names, batch_size=50):
+    """중복이 제거된 상품명을 카테고리별로 분류"""
     
     logger.debug("Starting product categorization.")
     category_mapping = {}
-    unique_names = list(set(product_names))
-    total_batches = len(unique_names) // batch_size + 1
-
-    for i in range(0, len(unique_names), batch_size):
-        batch = unique_names[i:i+batch_size]
-        prompt = (
-            "다음은 다양한 상품명 리스트입니다. 각 상품명을 '식품', '생활용품', '주류', '외식', '기타' 중 하나의 카테고리로 분류해주세요. "
-            "카테고리화 결과는 '상품명: 카테고리' 형식으로 한 줄에 하나씩 작성해주세요.\n\n"
+
+    # 캐시에 있는 상품명은 API 요청 없이 바로 사용
+    # 캐시 미스는 캐시 키 -> 원본 상품명 목록으로 모아 응답을 원본 이름에 다시 매핑
+    misses = []
+    miss_names = {}
+    for name in unique_names:
+        key = _category_cache_key(name)
+        category = category_cache.get(key)
+        if category is not None:
+            category_mapping[name] = category
+        elif key in miss_names:
+            miss_names[key].append(name)
+        else:
+            miss_names[key] = [name]
+            misses.append(name)
+    logger.debug(f"Category cache hits: {len(category_mapping)}, misses: {len(miss_names)}")
+
+    if not misses:
+        logger.debug("Product categorization completed.")
+        return category_mapping
+
+    batches = [misses[i:i+batch_size] for i in range(0, len(misses), batch_size)]
+
+    # 배치 요청을 동시에 전송하되 동시 요청 수는 세마포어로 제한
+    # 429 응답 시 재시도와 Retry-After 대기는 클라이언트가 처리
+    semaphore = asyncio.Semaphore(CATEGORIZE_CONCURRENCY)
+    async with AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=CATEGORIZE_MAX_RETRIES) as async_client:
+        results = await asyncio.gather(
+            *(_classify_batch(async_client, semaphore, batch) for batch in batches),
+            return_exceptions=True
         )
-        prompt += "\n".join(f"- {name}" for name in batch)
 
-        try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "당신은 유용한 카테고리 분류 도우미입니다."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1500,
-                temperature=0.3
-            )
-            response_content = response.choices[0].message['content'].strip()
-            logger.debug(f"Batch {i//batch_size + 1} response: {response_content}")
-
-            for line in response_content.split('\n'):
-                if ':' in line:
-                    product, category = line.split(':', 1)
-                    product = product.strip().lstrip('- ').strip()
-                    category = category.strip() if category.strip() in ['식품', '생활용품', '주류', '외식', '기타'] else '기타'
-                    category_mapping[product] = category
-                else:
-                    logger.warning(f"Incorrectly formatted line: {line}")
-
-            logger.info(f"Batch {i//batch_size + 1} categorization completed.")
-        except Exception as e:
-            logger.error(f"Error during categorization: {e}", exc_info=True)
+    for batch_no, items in enumerate(results, start=1):
+        if isinstance(items, Exception):
+            logger.error(f"Error during categorization: {items}", exc_info=items)
+            continue
+
+        for item in items:
+            if not isinstance(item, dict) or not item.get('name'):
+                logger.warning(f"Incorrectly formatted item: {item}")
+                continue
+            # 모델이 되돌려준 이름이 아니라 요청한 원본 상품명 기준으로 결과 저장
+            key = _category_cache_key(str(item['name']))
+            names = miss_names.get(key)
+            if names is None:
+                logger.warning(f"Unknown product name in categorization response: {item['name']}")
+                continue
+            category = item.get('category') if item.get('category') in VALID_CATEGORIES else '기타'
+            for name in names:
+                category_mapping[name] = category
+            category_cache[key] = category
+
+        logger.info(f"Batch {batch_no} categorization completed.")
 
     logger.debug("Product categorization completed.")
     return category_mapping
 
-def format_expenses_for_analysis(df, monthly_goal):
-    """지출 내역을 분석을 위한 문자열 형식으로 변환"""
+class MonthlyGoalError(Exception):
+    """월간 목표 금액 조회 실패 (카테고리 분류 실패와 구분하기 위함)"""
+    pass
+
+async def categorize_products_with_goal(unique_names, user_id):
+    """카테고리 분류가 진행되는 동안 월간 목표 금액을 별도 스레드에서 함께 조회"""
+    
+    goal_task = asyncio.create_task(asyncio.to_thread(fetch_monthly_goal, user_id))
+    category_mapping = await categorize_products(unique_names)
+    try:
+        monthly_goal = await goal_task
+    except Exception as e:
+        raise MonthlyGoalError(f"Failed to fetch monthly goal for user_id={user_id}") from e
+    return category_mapping, monthly_goal
+
+def format_expenses_for_analysis(df, top_n=15):
+    """지출 내역을 카테고리별 요약과 상위 지출 항목 CSV로 변환"""
     
     logger.debug("Formatting expenses for analysis.")
-    df['카테고리'] = df['카테고리'].fillna('미분류')
-    formatted = df.to_string(index=False, columns=['id', 'description', 'amount', '카테고리'])
-    return formatted, monthly_goal
+    # 모델이 직접 재집계하지 않도록 카테고리별 합계/건수를 미리 계산
+    summary = (
+        df.groupby('카테고리', observed=True)
+        .agg(total=('amount', 'sum'), count=('n', 'sum'))
+        .reset_index()
+    )
+    summary_csv = summary.to_csv(index=False)
+    top_csv = df.nlargest(top_n, 'amount').to_csv(index=False, columns=['description', 'amount', 'n', '카테고리'])
+    return summary_csv, top_csv
 
-def create_analysis_prompt(formatted_expenses, monthly_goal):
+def create_analysis_prompt(summary_csv, top_csv, monthly_goal, total_cents):
     """분석 요청을 위한 프롬프트를 생성"""
     
     logger.debug("Creating analysis prompt.")
     prompt = (
-        "아래는 사용자의 최근 한 달 간 지출 내역입니다. 이 지출 내역을 분석하여 한국어로 다음 정보를 JSON 형식으로 **반드시** 제공해주세요. "
+        "아래는 사용자의 최근 한 달 간 지출 내역 요약입니다. 이 지출 내역을 분석하여 한국어로 다음 정보를 JSON 형식으로 **반드시** 제공해주세요. "
         "응답은 반드시 JSON 코드 블록(```json`으로 시작하여 ```로 끝나야 합니다.)으로 작성해주세요.\n\n"
         "1. 총 지출 금액\n"
         "2. 주요 지출 카테고리\n"
         "3. 월간 예산 대비 초과 또는 절약 금액\n"
         "4. 지출 패턴 또는 트렌드\n"
         "5. 지출 절약을 위한 추천 사항\n\n"
-        f"월간 예산: {monthly_goal}원\n\n"
-        f"{formatted_expenses}\n"
+        f"월간 예산: {monthly_goal}원\n"
+        f"총 지출 금액: {total_cents / 100:.2f}원\n\n"
+        f"카테고리별 지출 합계:\n{summary_csv}\n"
+        f"금액 상위 지출 항목:\n{top_csv}\n"
         "응답은 반드시 JSON 코드 블록 안에 작성해주세요. 예시는 다음과 같습니다:\n\n"
         "```json\n"
         "{\n"
@@ -170,15 +266,15 @@ def create_analysis_prompt(formatted_expenses, monthly_goal):
     )
     return prompt
 
-def analyze_expenses(prompt, total_spending, retries=3):
+def analyze_expenses(prompt, total_cents, retries=3):
     """OpenAI API를 사용하여 지출 내역을 분석"""
     
     logger.debug("Starting expense analysis with OpenAI.")
     backoff = 1
     for attempt in range(retries):
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-4",
+            response = client.chat.completions.create(
+                model="gpt-4o-mini",
                 messages=[
                     {"role": "system", "content": "당신은 유용한 지출 분석 도우미입니다."},
                     {"role": "user", "content": prompt}
@@ -186,18 +282,18 @@ def analyze_expenses(prompt, total_spending, retries=3):
                 max_tokens=1000,
                 temperature=0.5
             )
-            response_content = response.choices[0].message['content'].strip()
+            response_content = response.choices[0].message.content.strip()
             logger.debug(f"Analysis response: {response_content}")
 
             # JSON 블록 추출
-            json_match = re.search(r'```json\s*(\{.*?\})\s*```', response_content, re.DOTALL)
+            json_match = JSON_BLOCK_RE.search(response_content)
             if not json_match:
-                json_match = re.search(r'(\{.*?\})', response_content, re.DOTALL)
+                json_match = JSON_FALLBACK_RE.search(response_content)
 
             if json_match:
                 try:
                     analysis = json.loads(json_match.group(1))
-                    analysis['총 지출 금액'] = float(total_spending)
+                    analysis['총 지출 금액'] = total_cents / 100
                     logger.info("Expense analysis succeeded.")
                     return analysis
                 except json.JSONDecodeError as json_err:
@@ -217,11 +313,9 @@ def analyze_expenses(prompt, total_spending, retries=3):
     logger.error("Expense analysis failed.")
     return {}
 
-def calculate_budget_difference(monthly_goal, total_spending):
-    """월간 예산 대비 초과 또는 절약 금액을 계산"""
-    
-    logger.debug("Calculating budget difference.")
-    difference = monthly_goal - total_spending
+def _format_budget_difference(difference_cents):
+    """센트 단위 예산 차액을 절약/초과 문자열로 변환"""
+    difference = Decimal(int(difference_cents)) / 100
     if difference > 0:
         return f"{difference:.2f}원 절약"
     elif difference < 0:
@@ -229,6 +323,22 @@ def calculate_budget_difference(monthly_goal, total_spending):
     else:
         return "예산과 지출이 동일합니다."
 
+def calculate_budget_difference(goal_cents, total_cents):
+    """월간 예산 대비 초과 또는 절약 금액을 계산 (센트 단위 정수 입력)"""
+    
+    logger.debug("Calculating budget difference.")
+    return _format_budget_difference(goal_cents - total_cents)
+
+def calculate_budget_difference_batch(monthly_goals, total_spendings):
+    """여러 사용자의 월간 예산 대비 초과 또는 절약 금액을 한 번에 계산"""
+    
+    logger.debug(f"Calculating budget differences for {len(monthly_goals)} users.")
+    # 원 단위 금액을 int64 센트로 변환하여 numpy에서 정확하게 일괄 차감
+    goals_cents = np.rint(np.asarray(monthly_goals, dtype='float64') * 100).astype('int64')
+    spends_cents = np.rint(np.asarray(total_spendings, dtype='float64') * 100).astype('int64')
+    differences = goals_cents - spends_cents
+    return [_format_budget_difference(cents) for cents in differences]
+
 class DecimalEncoder(json.JSONEncoder):
     """Decimal 타입을 float으로 변환하는 JSON 인코더"""
     
@@ -262,40 +372,47 @@ def main():
         print(json.dumps({'error': 'No spending data found'}, ensure_ascii=False))
         return
 
-    # 월간 목표 금액 로드
+    # 총 지출 금액 계산
+    # 이후 계산에서 반복 변환하지 않도록 센트 단위 정수로 한 번만 계산
+    total_cents = int(round(df['amount'].sum() * 100))
+    logger.info(f"Total spending: {total_cents / 100:.2f}원")
+
+    # 상품명 카테고리 분류 및 월간 목표 금액 로드
+    # 상품명이 NULL인 행은 분류하지 않고 '미분류'로 처리
+    unique_names = df['description'].dropna().drop_duplicates().tolist()
     try:
-        monthly_goal = fetch_monthly_goal(user_id)
-    except Exception as e:
+        category_mapping, monthly_goal = asyncio.run(categorize_products_with_goal(unique_names, user_id))
+    except MonthlyGoalError:
         logger.error(f"Failed to fetch monthly goal for user_id={user_id}.", exc_info=True)
         print(json.dumps({'error': 'Failed to fetch monthly goal'}, ensure_ascii=False))
         return
+    except Exception:
+        logger.error(f"Failed to categorize products for user_id={user_id}.", exc_info=True)
+        print(json.dumps({'error': 'Failed to categorize products'}, ensure_ascii=False))
+        return
+    goal_cents = int(monthly_goal * 100)
+    df['카테고리'] = pd.Categorical(
+        df['description'].map(category_mapping).fillna('미분류'),
+        dtype=CATEGORY_DTYPE
+    )
 
-    # 총 지출 금액 계산
-    total_spending = df['amount'].sum()
-    logger.info(f"Total spending: {total_spending:.2f}원")
-
-    # 상품명 카테고리 분류
-    product_names = df['description'].tolist()
-    category_mapping = categorize_products(product_names)
-    df['카테고리'] = df['description'].map(category_mapping).fillna('미분류')
-
-    # 지출 내역 형식화
-    formatted_expenses, monthly_goal = format_expenses_for_analysis(df, monthly_goal)
+    # 지출 내역 요약
+    summary_csv, top_csv = format_expenses_for_analysis(df)
 
     # 분석 프롬프트 생성
-    prompt = create_analysis_prompt(formatted_expenses, monthly_goal)
+    prompt = create_analysis_prompt(summary_csv, top_csv, monthly_goal, total_cents)
 
     # 지출 내역 분석 수행
-    analysis = analyze_expenses(prompt, total_spending)
+    analysis = analyze_expenses(prompt, total_cents)
 
     # 예산 대비 초과 또는 절약 금액 계산
-    budget_difference = calculate_budget_difference(monthly_goal, Decimal(total_spending))
+    budget_difference = calculate_budget_difference(goal_cents, total_cents)
     analysis['월간 예산 대비 초과 또는 절약 금액'] = budget_difference
 
     # 분석 결과 출력
     if analysis:
         try:
-            print(json.dumps(analysis, indent=4, ensure_ascii=False, cls=DecimalEncoder))
+            print(json.dumps(analysis, ensure_ascii=False, cls=DecimalEncoder))
             logger.info("Successfully printed expense analysis results.")
         except TypeError as te:
             logger.error(f"JSON serialization error: {te}", exc_info=True)
@@ -1,14 +1,36 @@
 import subprocess
 import os
+import io
 import logging
-import json
+import logging.handlers
+import queue
+import atexit
 from datetime import datetime
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
+from flask import Flask, Request, Response, request, jsonify
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity, exceptions
+from werkzeug.exceptions import RequestEntityTooLarge
+from receipt_ocr import process_images, ReceiptProcessingError
+
+class ReceiptUploadRequest(Request):
+    """영수증 업로드 파일을 디스크에 쓰지 않고 메모리 버퍼에 보관하는 요청 클래스"""
+
+    upload_endpoints = {'process_request'}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint not in self.upload_endpoints:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        # 크기와 무관하게 메모리에 보관 (기본 구현은 500KB 초과 시 임시 파일로 넘김)
+        return io.BytesIO()
 
 app = Flask(__name__)
+app.request_class = ReceiptUploadRequest
+# 한글 응답을 \uXXXX 이스케이프 없이 UTF-8 그대로 직렬화하고 키 정렬 생략
+app.json.ensure_ascii = False
+app.json.sort_keys = False
+# 업로드 요청 최대 크기 (초과 시 본문을 읽기 전에 413 응답)
+app.config['MAX_CONTENT_LENGTH'] = 30 * 1024 * 1024
 load_dotenv()
 
 # JWT 설정
@@ -17,34 +39,42 @@ app.config['JWT_ALGORITHM'] = 'HS512'  # JWT 알고리즘 설정
 
 if not app.config['JWT_SECRET_KEY']:
     raise ValueError("JWT_SECRET_KEY environment variable is not set.")
-app.logger.debug(f"JWT_SECRET_KEY loaded: {app.config['JWT_SECRET_KEY']}")
 app.logger.debug(f"JWT_ALGORITHM set to: {app.config['JWT_ALGORITHM']}")
 
 jwt_manager = JWTManager(app)
 
 # 로깅 설정
 log_file = 'error.log'  # 로그 파일 경로
-if not os.path.exists(log_file):
-    open(log_file, 'a').close()
 
 file_handler = logging.FileHandler(log_file)
 file_handler.setLevel(logging.DEBUG)
 formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(message)s')
 file_handler.setFormatter(formatter)
 
-app.logger.addHandler(file_handler)
+# 요청 처리 스레드가 파일 쓰기를 기다리지 않도록 큐를 거쳐 백그라운드에서 기록
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+app.logger.addHandler(logging.handlers.QueueHandler(log_queue))
 app.logger.setLevel(logging.DEBUG)
 
 # CORS 설정: 허용할 URL 정의
+ALLOWED_ORIGINS = (
+    "http://localhost:5173",
+    "https://pjx-client.vercel.app"
+)
+
 cors = CORS(app, resources={
     r"/*": {
-        "origins": [
-            "http://localhost:5173",
-            "https://pjx-client.vercel.app"
-        ]
+        "origins": list(ALLOWED_ORIGINS)
     }
 }, supports_credentials=True)
 
+# 요청 본문 디버그 로그 최대 크기 (바이트)
+MAX_LOGGED_BODY_SIZE = 4096
+
 # 보호된 엔드포인트 리스트
 protected_endpoints = [
     'process_request',
@@ -54,8 +84,18 @@ protected_endpoints = [
 @app.before_request
 def log_request_info():
     app.logger.debug(f"Request Path: {request.path}")
-    app.logger.debug(f"Request Headers: {dict(request.headers)}")
-    app.logger.debug(f"Request Body: {request.get_data()}")
+    # 토큰이 로그에 남지 않도록 Authorization 헤더는 가림 처리
+    if app.logger.isEnabledFor(logging.DEBUG):
+        headers = dict(request.headers)
+        if 'Authorization' in headers:
+            headers['Authorization'] = '<redacted>'
+        app.logger.debug(f"Request Headers: {headers}")
+    # 업로드 본문 전체를 메모리로 읽지 않도록 작은 비-멀티파트 본문만 기록
+    if (app.logger.isEnabledFor(logging.DEBUG)
+            and request.mimetype != 'multipart/form-data'
+            and request.content_length
+            and request.content_length < MAX_LOGGED_BODY_SIZE):
+        app.logger.debug(f"Request Body: {request.get_data()}")
     
     # 현재 요청된 엔드포인트 확인
     endpoint = request.endpoint
@@ -77,7 +117,7 @@ def invalid_token_callback(reason):
 
 @jwt_manager.expired_token_loader
 def expired_token_callback(jwt_header, jwt_payload):
-    app.logger.warning(f"Expired JWT Token: {jwt_payload}")
+    app.logger.warning(f"Expired JWT Token for identity: {jwt_payload.get('sub')}")
     return jsonify({'error': 'Expired JWT Token'}), 401
 
 @app.route('/')
@@ -91,12 +131,18 @@ def health_check():
     app.logger.debug(f"Health check response: {response.get_data(as_text=True)}")
     return response
 
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    app.logger.error(f"Request too large: {request.content_length} bytes")
+    return jsonify({'error': 'Request too large', 'details': f"Maximum {app.config['MAX_CONTENT_LENGTH']} bytes allowed"}), 413
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     app.logger.error(f"Unhandled exception: {e}", exc_info=True)
     response = jsonify({'error': 'An unexpected error occurred', 'details': str(e)})
     response.status_code = 500
-    app.logger.debug(f"Error Response Headers: {dict(response.headers)}")
+    if app.logger.isEnabledFor(logging.DEBUG):
+        app.logger.debug(f"Error Response Headers: {dict(response.headers)}")
     return response
 
 @app.route('/api/v1/receipt/analyze', methods=['POST'])
@@ -119,32 +165,29 @@ def process_request():
             app.logger.error('More than 3 files uploaded.')
             return jsonify({'error': 'Maximum 3 files allowed'}), 400
 
-        image_paths = {}
-        temp_dir = '/tmp'
+        images = []
 
-        # 파일 저장 및 경로 지정
-        for idx, file in enumerate(files, start=1):
+        # 업로드 이미지 바이트를 임시 파일 없이 메모리에서 바로 전달
+        for file in files:
             if file.filename == '':
                 app.logger.error('One of the files has no filename.')
                 return jsonify({'error': 'One of the files has no filename'}), 400
-            file_path = os.path.join(temp_dir, f'image_{idx}_{file.filename}')
-            file.save(file_path)
-            image_type = f'Receipt{idx}'
-            image_paths[image_type] = file_path
+            images.append((file.filename, file.read()))
 
-        # receipt_ocr.py 실행, 입력 이미지 경로 전달
+        # 영수증 OCR 및 요약을 워커 프로세스 안에서 직접 수행
         try:
-            result = subprocess.check_output(['python3', 'receipt_ocr.py'] + list(image_paths.values()), stderr=subprocess.STDOUT)
-            result_data = result.decode('utf-8')
-            app.logger.debug(f"Subprocess result: {result_data}")
+            result_data = process_images(images)
+            app.logger.debug(f"Receipt processing result: {result_data}")
             return jsonify({'result': result_data}), 200
-        except subprocess.CalledProcessError as e:
-            app.logger.error(f"Subprocess error: {e.output.decode('utf-8')}")
-            return jsonify({'error': 'Error processing images', 'details': e.output.decode('utf-8')}), 500
+        except ReceiptProcessingError as e:
+            app.logger.error(f"Receipt processing error: {e}")
+            return jsonify({'error': 'Error processing images', 'details': str(e)}), 500
         except Exception as e:
-            app.logger.error(f"Unexpected error in subprocess: {e}")
+            app.logger.error(f"Unexpected error in image processing: {e}")
             return jsonify({'error': 'Unexpected error occurred during image processing', 'details': str(e)}), 500
 
+    except RequestEntityTooLarge:
+        raise
     except Exception as err:
         app.logger.error(f"Unhandled exception: {err}", exc_info=True)
         return jsonify({'error': 'An unexpected error occurred', 'details': str(err)}), 500
@@ -175,20 +218,20 @@ def analyze_spending():
             app.logger.debug(f"Executing command: {' '.join(command)}")
             result = subprocess.check_output(
                 command,
-                stderr=subprocess.STDOUT
+                stderr=subprocess.PIPE
             )
-            result_data = result.decode('utf-8')
-            analysis_result = json.loads(result_data)
-            app.logger.debug(f"Analysis result JSON: {analysis_result}")
-            return jsonify(analysis_result), 200
+            # analyze.py가 출력한 JSON을 다시 파싱/직렬화하지 않고 그대로 응답 (형태만 간단히 확인)
+            if not result.lstrip().startswith(b'{'):
+                app.logger.error("Invalid JSON response from analysis script.")
+                app.logger.debug(f"Result data: {result[:MAX_LOGGED_BODY_SIZE]!r}")
+                return jsonify({'error': 'Invalid JSON response from analysis script'}), 500
+            if app.logger.isEnabledFor(logging.DEBUG):
+                app.logger.debug(f"Analysis result JSON: {result.decode('utf-8')}")
+            return Response(result, status=200, mimetype='application/json')
         except subprocess.CalledProcessError as e:
-            error_output = e.output.decode('utf-8')
+            error_output = (e.stderr or e.output).decode('utf-8')
             app.logger.error(f"Subprocess error: {error_output}")
             return jsonify({'error': 'Error processing analysis', 'details': error_output}), 500
-        except json.JSONDecodeError as e:
-            app.logger.error(f"JSON decode error: {e}")
-            app.logger.debug(f"Result data: {result_data}")
-            return jsonify({'error': 'Invalid JSON response from analysis script', 'details': str(e)}), 500
         except Exception as e:
             app.logger.error(f"Unexpected error in subprocess: {e}", exc_info=True)
             return jsonify({'error': 'Unexpected error occurred during spending analysis', 'details': str(e)}), 500
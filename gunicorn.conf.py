@@ -0,0 +1,22 @@
+# gunicorn 설정 (실행: gunicorn app:app)
+# 개발 서버(app.run) 대신 멀티 워커/스레드로 요청을 동시에 처리
+
+bind = '0.0.0.0:5000'
+
+# OCR 요청은 대부분 외부 API 대기 시간이므로 워커당 스레드로 동시 처리
+workers = 2
+worker_class = 'gthread'
+threads = 8
+
+# 메모리 누수 누적 방지를 위해 일정 요청 수마다 워커 재시작
+max_requests = 1000
+max_requests_jitter = 100
+
+# 워커 heartbeat 파일을 디스크 대신 메모리 파일시스템에 기록
+worker_tmp_dir = '/dev/shm'
+
+# preload_app을 켜면 안 됨: app.py와 receipt_ocr.py는 import 시 로그용 QueueListener 스레드를 시작하는데,
+# preload 시 이 스레드는 마스터에만 존재하고 fork된 워커에는 복제되지 않음
+# 워커의 로그는 아무도 비우지 않는 무제한 큐에 쌓여 유실되고 메모리가 계속 증가함
+# (작업 풀은 첫 요청 시 워커별로 생성되므로 preload 여부와 무관)
+preload_app = False
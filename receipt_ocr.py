@@ -1,139 +1,387 @@
-import cv2
 import numpy as np
 import os
 import sys
 import time
-import mimetypes
-import uuid
 import json
 import logging
+import logging.handlers
+import queue
+import hashlib
+import atexit
+import threading
+import functools
+import multiprocessing
+from itertools import chain
+from operator import itemgetter
 import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import diskcache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from dotenv import load_dotenv
 
 # 환경 변수 로드
 load_dotenv()
 
 # 로깅 설정
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler("app.log")
-    ]
+# OCR 스레드가 콘솔/파일 쓰기를 기다리지 않도록 큐를 거쳐 백그라운드에서 기록
+# CLI가 stdout으로 스트리밍하는 요약 결과와 섞이지 않도록 콘솔 로그는 stderr로 출력
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(
+    log_queue,
+    logging.StreamHandler(sys.stderr),
+    logging.FileHandler("app.log")
 )
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# import한 쪽(Flask 앱)의 루트 로거 설정에 영향을 주지 않도록 모듈 로거에만 핸들러 연결
+queue_handler = logging.handlers.QueueHandler(log_queue)
+queue_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(queue_handler)
+logger.propagate = False
+
+# API 정보 (Flask 워커에서 import 시 한 번만 읽음)
+OCR_API_URL = os.getenv('OCR_API_URL')
+OCR_SECRET_KEY = os.getenv('SECRET_KEY')
+OPENAI_API_URL = os.getenv('OPENAI_API_URL')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+
+# 전처리 최대 이미지 너비 (영수증 OCR 정확도는 이 이상에서 더 높아지지 않음)
+MAX_PREPROCESS_WIDTH = 1600
+
+@functools.cache
+def _cv2():
+    """OpenCV 모듈을 처음 사용할 때 로드 (import 비용이 커서 전처리 프로세스에서만 로드)"""
+    import cv2
+    return cv2
+
+@functools.cache
+def _cuda_available():
+    """CUDA 지원 OpenCV 빌드이고 사용 가능한 GPU가 있는지 확인"""
+    cv2 = _cv2()
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except (AttributeError, cv2.error):
+        return False
+
+@functools.cache
+def _rect_kernel(width, height):
+    """사각형 구조 요소 (크기별로 한 번만 생성하여 재사용)"""
+    cv2 = _cv2()
+    return cv2.getStructuringElement(cv2.MORPH_RECT, (width, height))
+
+# 커널 크기별 CUDA 필터 객체 (프로세스마다 처음 사용할 때 생성하여 재사용)
+_cuda_filters = {}
+
+# 지원하는 입력 이미지 확장자별 MIME 타입
+SUPPORTED_IMAGE_TYPES = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png'
+}
+
+# OCR 업로드 형식별 인코딩 파라미터 (cv2 상수 이름: 값)
+# 전처리 결과는 이진화 이미지이므로 기본값은 1비트 PNG, 낮은 압축 레벨
+UPLOAD_ENCODINGS = {
+    'png': {'IMWRITE_PNG_COMPRESSION': 1, 'IMWRITE_PNG_BILEVEL': 1},
+    'jpg': {'IMWRITE_JPEG_QUALITY': 85}
+}
+
+OCR_UPLOAD_FORMAT = os.getenv('OCR_UPLOAD_FORMAT', 'png').lower()
+if OCR_UPLOAD_FORMAT not in UPLOAD_ENCODINGS:
+    raise ValueError(f"Unsupported OCR_UPLOAD_FORMAT: {OCR_UPLOAD_FORMAT}")
+
+@functools.cache
+def _upload_encode_params():
+    """cv2.imencode에 넘길 업로드 형식 인코딩 파라미터 리스트"""
+    cv2 = _cv2()
+    params = []
+    for name, value in UPLOAD_ENCODINGS[OCR_UPLOAD_FORMAT].items():
+        params.extend([getattr(cv2, name), value])
+    return params
+
+# 전처리 여부 (false이면 원본 이미지를 디코딩/재인코딩 없이 그대로 업로드)
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', 'true').lower() == 'true'
+
+# 요약 요청 시스템 메시지 (요청마다 동일)
+SUMMARY_SYSTEM_MESSAGE = {'role': 'system', 'content': 'You are a helper that organizes and summarizes data.'}
+
+# 요약 요청 프롬프트 (뒤에 OCR 결과가 이어짐)
+SUMMARY_PROMPT_HEADER = (
+    "다음은 상품 목록과 관련된 데이터로, '[상품명] [단가] [수량] [금액]'으로 구성되어 있습니다.\n"
+    "각 항목별로 번호를 매기고, **상품명과 총액(단가 * 수량)**만 아래와 같은 형식으로 정리해주세요:\n\n"
+    "0: [상품명] $[총액]\n"
+    "1: [상품명] $[총액]\n"
+    "...\n\n"
+    "입력 데이터:"
+)
+
+# 이미지 내용 해시 -> OCR 결과 캐시 (같은 영수증 재업로드 시 OCR API 호출 생략)
+ocr_cache = diskcache.Cache(os.getenv('OCR_CACHE_DIR', '.cache/ocr'))
+
+def _build_session():
+    """커넥션 풀과 재시도가 설정된 HTTP 세션 생성"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=16,
+        # 기본값은 POST를 재시도하지 않으므로 명시적으로 허용
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.2,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=['POST'],
+            raise_on_status=False
+        )
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# HTTP 세션 (요청 간 OCR/OpenAI 연결 재사용)
+_session = _build_session()
+
+# 요약 API 서버가 유휴 keep-alive 연결을 유지한다고 보는 시간 (초)
+# 마지막 응답 후 이 시간 안이면 연결이 풀에 남아 있다고 보고 prewarm 생략
+SUMMARY_KEEPALIVE_SECONDS = 30
+_last_summary_response = float('-inf')
+
+# OCR API 동시 요청 수 및 초당 요청 수 제한 (프로세스 단위, 업스트림 스로틀링 방지)
+OCR_MAX_CONCURRENCY = 3
+OCR_RATE_LIMIT = 5
+
+class _RateLimiter:
+    """초당 호출 수를 제한하는 토큰 버킷 (스레드 안전)"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # 토큰이 없으면 다음 토큰이 채워질 때까지 대기 (대기 중인 호출은 순서대로 진행)
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+_ocr_rate_limiter = _RateLimiter(OCR_RATE_LIMIT)
+
+# 작업 풀 (프로세스마다 처음 사용할 때 생성하여 요청 간 재사용)
+_process_pool = None
+_thread_pool = None
+_pool_lock = threading.Lock()
+
+def _get_pools():
+    """전처리용 프로세스 풀과 OCR 요청용 스레드 풀 반환"""
+    global _process_pool, _thread_pool
+    with _pool_lock:
+        # 자식 프로세스가 강제 종료(OOM 등)되어 풀이 깨졌으면 새로 생성
+        if _process_pool is None or _process_pool._broken:
+            if _process_pool is not None:
+                logger.warning("Preprocessing process pool is broken. Recreating it.")
+                _process_pool.shutdown(wait=False)
+            # 멀티스레드 웹 워커에서 fork 하지 않도록 spawn 사용
+            _process_pool = ProcessPoolExecutor(
+                max_workers=min(3, os.cpu_count() or 1),
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        if _thread_pool is None:
+            _thread_pool = ThreadPoolExecutor(max_workers=OCR_MAX_CONCURRENCY)
+            atexit.register(_shutdown_pools)
+    return _process_pool, _thread_pool
+
+def _shutdown_pools():
+    """종료 시 작업 풀 정리"""
+    if _process_pool is not None:
+        _process_pool.shutdown()
+    if _thread_pool is not None:
+        _thread_pool.shutdown()
+
+def _image_cache_key(image_data):
+    """원본 이미지 내용의 해시를 OCR 결과 캐시 키로 사용"""
+    return hashlib.blake2b(image_data, digest_size=16).hexdigest()
+
+def _image_format(image_name):
+    """파일 확장자로 이미지 형식 반환"""
+    return os.path.splitext(image_name)[1][1:].lower()
+
+def validate_image_name(image_name):
+    # 이미지 형식 검증 (확장자 기준)
+    if _image_format(image_name) not in SUPPORTED_IMAGE_TYPES:
+        logger.error(f"Unsupported image format: {image_name}")
+        return False
+    return True
 
 def validate_image_path(image_path):
     # 이미지 경로 및 형식 검증
     if not os.path.isfile(image_path):
         logger.error(f"File does not exist: {image_path}")
         return False
-    mime_type, _ = mimetypes.guess_type(image_path)
-    if mime_type not in ['image/jpeg', 'image/png', 'image/jpg']:
-        logger.error(f"Unsupported image format: {image_path} (MIME type: {mime_type})")
-        return False
-    return True
+    return validate_image_name(image_path)
 
-def preprocess_receipt_image(image_path):
+def load_images(image_paths):
     """
-    이미지 전처리
+    CLI 입력 경로의 이미지를 (파일명, 바이트) 리스트로 로드
     """
-    # 이미지 로드
-    image = cv2.imread(image_path)
-    if image is None:
-        logger.error(f"Failed to load image from: {image_path}")
-        return None
-
-    # 원본 이미지 복사
-    original = image.copy()
-
-    # 그레이스케일 변환
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    images = []
+    for path in image_paths:
+        if validate_image_path(path):
+            images.append((path, np.fromfile(path, dtype=np.uint8)))
+        else:
+            logger.warning(f"Invalid image path: {path}. Skipping this file.")
+    return images
 
+def _remove_shadow(gray, kernel_size):
+    """
+    배경을 추정하여 그림자를 제거
+    """
+    cv2 = _cv2()
     # 모폴리지 닫기 연산으로 노이즈 제거 및 그림자 완화
-    img_height, img_width = gray.shape
-    kernel_size = max(5, int(img_width * 0.02))
-    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
-    closed = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel, iterations=2)
+    kernel = _rect_kernel(kernel_size, kernel_size)
+    work = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel, iterations=1)
 
+    # 이후 단계는 새 배열을 할당하지 않도록 work 버퍼에 덮어쓰며 진행
     # 그림자 제거를 위한 배경 추정 및 차감
-    background = cv2.GaussianBlur(closed, (15, 15), 0)
-    diff = cv2.absdiff(gray, background)
+    cv2.blur(work, (15, 15), dst=work)
+    cv2.absdiff(gray, work, dst=work)
+    return work
+
+def _get_cuda_filters(kernel_size):
+    """닫기 연산 및 배경 블러용 CUDA 필터 반환"""
+    cv2 = _cv2()
+    filters = _cuda_filters.get(kernel_size)
+    if filters is None:
+        kernel = _rect_kernel(kernel_size, kernel_size)
+        filters = (
+            cv2.cuda.createMorphologyFilter(cv2.MORPH_CLOSE, cv2.CV_8UC1, kernel),
+            cv2.cuda.createBoxFilter(cv2.CV_8UC1, cv2.CV_8UC1, (15, 15))
+        )
+        _cuda_filters[kernel_size] = filters
+    return filters
+
+def _remove_shadow_cuda(gray, kernel_size):
+    """
+    _remove_shadow의 CUDA 버전 (업로드/다운로드는 한 번씩만 수행)
+    """
+    cv2 = _cv2()
+    close_filter, blur_filter = _get_cuda_filters(kernel_size)
+    gpu_gray = cv2.cuda_GpuMat()
+    gpu_gray.upload(gray)
 
-    # 정규화하여 명암 대비 향상
-    norm = cv2.normalize(diff, None, 0, 255, cv2.NORM_MINMAX)
+    gpu_background = blur_filter.apply(close_filter.apply(gpu_gray))
+    return cv2.cuda.absdiff(gpu_gray, gpu_background).download()
 
-    # 노이즈 제거
-    blurred = cv2.GaussianBlur(norm, (5, 5), 0)
+def preprocess_receipt_image(image_data):
+    """
+    이미지 전처리
+    """
+    cv2 = _cv2()
+    # 이미지 디코딩 (임시 파일 없이 메모리에서 바로 그레이스케일로 디코딩)
+    gray = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        logger.error("Failed to decode image.")
+        return None
 
-    # 이진화 (Otsu Thresholding)
-    _, thresh = cv2.threshold(
-        blurred,
+    # OCR 정확도에 영향이 없는 크기로 축소하여 이후 연산량 감소
+    img_height, img_width = gray.shape
+    if img_width > MAX_PREPROCESS_WIDTH:
+        scale = MAX_PREPROCESS_WIDTH / img_width
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        img_height, img_width = gray.shape
+
+    # 배경 추정 및 그림자 제거 (GPU가 있으면 CUDA 사용)
+    kernel_size = max(5, int(img_width * 0.02))
+    if _cuda_available():
+        work = _remove_shadow_cuda(gray, kernel_size)
+    else:
+        work = _remove_shadow(gray, kernel_size)
+
+    # 이진화 (Otsu는 전역 임계값을 고르므로 사전 블러 없이 적용)
+    # 최소-최대 정규화는 밝기 순서를 유지하는 선형 변환이라 Otsu 결과가 사실상 같으므로 생략
+    cv2.threshold(
+        work,
         0,
         255,
-        cv2.THRESH_BINARY + cv2.THRESH_OTSU
+        cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+        dst=work
     )
 
     # 팽창을 통해 텍스트 선명화
-    kernel_dilate = cv2.getStructuringElement(cv2.MORPH_RECT, (2, 2))
-    processed = cv2.dilate(thresh, kernel_dilate, iterations=1)  
+    cv2.dilate(work, _rect_kernel(2, 2), dst=work, iterations=1)
 
-    return processed
+    return work
 
-def perform_ocr(api_url, secret_key, image_info, session, timeout=20):
+def preprocess_and_encode(image_info):
     """
-    OCR API를 호출하여 이미지에서 텍스트를 추출
+    이미지 전처리 후 업로드 형식 버퍼로 인코딩 (CPU 작업, 프로세스 풀에서 실행)
     """
-    image_type, image_path = image_info
-    if not validate_image_path(image_path):
-        return image_type, ""
-
+    cv2 = _cv2()
+    image_type, image_data = image_info
     try:
         # 이미지 전처리
-        processed_image = preprocess_receipt_image(image_path)
+        processed_image = preprocess_receipt_image(image_data)
         if processed_image is None:
-            logger.error(f"Preprocessing failed for: {image_path}")
-            return image_type, ""
+            logger.error(f"Preprocessing failed for: {image_type}")
+            return image_type, None
 
         # 전처리된 이미지를 메모리 버퍼로 인코딩
-        success, encoded_image = cv2.imencode('.png', processed_image)
+        success, encoded_image = cv2.imencode(f'.{OCR_UPLOAD_FORMAT}', processed_image, _upload_encode_params())
         if not success:
-            logger.error(f"Image encoding failed for: {image_path}")
-            return image_type, ""
+            logger.error(f"Image encoding failed for: {image_type}")
+            return image_type, None
 
-        # 인코딩된 이미지를 바이트로 변환
-        image_bytes = encoded_image.tobytes()
+        # 바이트로 복사하지 않고 인코딩된 numpy 버퍼를 그대로 반환
+        return image_type, encoded_image
+    except Exception as e:
+        logger.error(f"Unexpected exception during preprocessing for: {image_type}, Exception: {e}")
+        return image_type, None
 
-        # MIME 타입 설정
-        mime_type, _ = mimetypes.guess_type(image_path)
-        format_type = mime_type.split('/')[-1] if mime_type else 'png'
-        unique_name = f"{image_type}_{uuid.uuid4()}.{format_type}"
+def perform_ocr(api_url, secret_key, image_type, image_buffer, session, format_type=OCR_UPLOAD_FORMAT, timeout=20):
+    """
+    OCR API를 호출하여 이미지에서 텍스트를 추출 (I/O 작업)
+    """
+    try:
+        request_id = os.urandom(16).hex()
+        unique_name = f"{image_type}_{request_id}.{format_type}"
 
         # OCR API 요청 JSON 설정
         request_json = {
             'images': [{'format': format_type, 'name': unique_name}],
-            'requestId': str(uuid.uuid4()),
+            'requestId': request_id,
             'version': 'V2',
-            'timestamp': int(round(time.time() * 1000))
+            'timestamp': time.time_ns() // 1_000_000
         }
-        payload = {'message': json.dumps(request_json).encode('UTF-8')}
-        files = {'file': (unique_name, image_bytes, mime_type if mime_type else 'image/png')}
+        payload = {'message': json.dumps(request_json, separators=(',', ':')).encode('UTF-8')}
+        # 인코딩 버퍼를 memoryview로 감싸 멀티파트 본문에 복사 없이 전달
+        files = {'file': (unique_name, memoryview(image_buffer), SUPPORTED_IMAGE_TYPES[format_type])}
         headers = {'X-OCR-SECRET': secret_key}
 
         # OCR API 요청
+        _ocr_rate_limiter.acquire()
         response = session.post(api_url, headers=headers, data=payload, files=files, timeout=timeout)
 
         if response.status_code == 200:
-            ocr_result = response.json()
-            text_results = " ".join([
-                field['inferText']
-                for image in ocr_result.get('images', [])
-                for field in image.get('fields', [])
-            ])
+            ocr_result = json.loads(response.content)
+            # 필드 순회와 텍스트 추출을 C 레벨 반복(chain/map)으로 처리
+            fields = chain.from_iterable(image.get('fields', ()) for image in ocr_result.get('images', ()))
+            text_results = " ".join(map(itemgetter('inferText'), fields))
             logger.info(f"OCR succeeded for: {image_type}")
             return image_type, text_results
+        elif response.status_code == 429:
+            logger.warning(f"OCR request throttled for: {image_type} after retries, Response: {response.text}")
+            return image_type, ""
         else:
             logger.error(f"OCR request failed for: {image_type}, Status Code: {response.status_code}, Response: {response.text}")
             return image_type, ""
@@ -145,10 +393,30 @@ def perform_ocr(api_url, secret_key, image_info, session, timeout=20):
         logger.error(f"Unexpected exception during OCR processing for: {image_type}, Exception: {e}")
     return image_type, ""
 
-def perform_summarization(api_url, api_key, prompt, session, timeout=25):
+def _read_summary_stream(response, on_delta):
+    """
+    SSE 스트림의 텍스트 조각을 도착하는 대로 on_delta에 전달하고 전체 텍스트 반환
+    """
+    parts = []
+    for line in response.iter_lines():
+        if not line.startswith(b'data: '):
+            continue
+        chunk = line[len(b'data: '):]
+        if chunk == b'[DONE]':
+            break
+        choices = json.loads(chunk)['choices']
+        delta = choices[0]['delta'].get('content') if choices else None
+        if delta:
+            parts.append(delta)
+            on_delta(delta)
+    return "".join(parts)
+
+def perform_summarization(api_url, api_key, prompt, session, timeout=25, on_delta=None):
     """
     OpenAI API를 호출하여 텍스트 요약을 수행
+    on_delta가 주어지면 스트리밍으로 요청하여 생성되는 텍스트 조각마다 호출
     """
+    global _last_summary_response
     headers = {
         'Content-Type': 'application/json',
         'Authorization': f'Bearer {api_key}',
@@ -156,18 +424,25 @@ def perform_summarization(api_url, api_key, prompt, session, timeout=25):
     data = {
         'model': 'gpt-3.5-turbo',
         'messages': [
-            {'role': 'system', 'content': 'You are a helper that organizes and summarizes data.'},
+            SUMMARY_SYSTEM_MESSAGE,
             {'role': 'user', 'content': prompt}
         ],
         'max_tokens': 1000,
         'temperature': 0.2,
     }
+    streaming = on_delta is not None
+    if streaming:
+        data['stream'] = True
 
     try:
-        response = session.post(api_url, headers=headers, json=data, timeout=timeout)
+        response = session.post(api_url, headers=headers, json=data, timeout=timeout, stream=streaming)
+        _last_summary_response = time.monotonic()
         if response.status_code == 200:
-            result = response.json()
-            output = result['choices'][0]['message']['content']
+            if streaming:
+                output = _read_summary_stream(response, on_delta)
+            else:
+                result = json.loads(response.content)
+                output = result['choices'][0]['message']['content']
             logger.info("Summarization succeeded.")
             return output.strip()
         else:
@@ -181,86 +456,136 @@ def perform_summarization(api_url, api_key, prompt, session, timeout=25):
         logger.error(f"Unexpected exception during summarization: {e}")
     return None
 
-def main(*image_paths):
+def _summary_connection_is_warm():
+    """최근 keep-alive 유지 시간 안에 요약 API 응답을 받았는지 (연결이 풀에 남아 있을 가능성이 높음)"""
+    return time.monotonic() - _last_summary_response < SUMMARY_KEEPALIVE_SECONDS
+
+def prewarm_connection(api_url, session, timeout=5):
     """
-    OCR 및 요약 작업 수행
+    요약 API 연결(TCP/TLS)을 미리 맺어 풀에 유지 (OCR 대기 시간과 겹쳐 수행)
     """
-    # OCR API 정보
-    ocr_api_url = os.getenv('OCR_API_URL')
-    if not ocr_api_url:
-        logger.error("Environment variable OCR_API_URL is not set.")
-        sys.exit(1)
-    secret_key = os.getenv('SECRET_KEY')
+    global _last_summary_response
+    try:
+        session.head(api_url, timeout=timeout)
+        _last_summary_response = time.monotonic()
+    except requests.exceptions.RequestException as e:
+        logger.debug(f"Connection prewarm failed: {e}")
 
-    if not secret_key:
-        logger.error("Environment variable SECRET_KEY is not set.")
-        sys.exit(1)
+class ReceiptProcessingError(Exception):
+    """영수증 OCR 및 요약 처리 실패"""
 
-    # OpenAI API 정보
-    openai_api_url = os.getenv('OPENAI_API_URL')
-    if not openai_api_url:
-        logger.error("Environment variable OPENAI_API_URL is not set.")
-        sys.exit(1)
-    openai_api_key = os.getenv("OPENAI_API_KEY")
-    if not openai_api_key:
-        logger.error("Environment variable OPENAI_API_KEY is not set.")
-        sys.exit(1)
-
-    # 이미지 경로들 검증
-    valid_image_paths = []
-    for i, path in enumerate(image_paths):
+def process_images(images, on_delta=None):
+    """
+    (파일명, 이미지 바이트) 리스트에 대해 OCR 및 요약 작업 수행 후 요약 결과 문자열 반환
+    on_delta가 주어지면 요약 결과를 스트리밍으로 받아 조각마다 호출
+    """
+    # API 정보 확인
+    required_settings = {
+        'OCR_API_URL': OCR_API_URL,
+        'SECRET_KEY': OCR_SECRET_KEY,
+        'OPENAI_API_URL': OPENAI_API_URL,
+        'OPENAI_API_KEY': OPENAI_API_KEY,
+    }
+    for name, value in required_settings.items():
+        if not value:
+            logger.error(f"Environment variable {name} is not set.")
+            raise ReceiptProcessingError(f"Environment variable {name} is not set.")
+
+    # 이미지 형식 검증
+    valid_images = []
+    image_formats = {}
+    for i, (image_name, image_data) in enumerate(images):
         image_type = f'Receipt{i+1}'
-        if validate_image_path(path):
-            valid_image_paths.append((image_type, path))
+        if len(image_data) and validate_image_name(image_name):
+            valid_images.append((image_type, image_data))
+            image_formats[image_type] = _image_format(image_name)
         else:
-            logger.warning(f"Invalid image path: {path}. Skipping this file.")
+            logger.warning(f"Invalid image: {image_name}. Skipping this file.")
 
-    if not valid_image_paths:
+    if not valid_images:
         logger.error("No valid image files provided.")
-        sys.exit(1)
-
-    # 세션 설정
-    session = requests.Session()
+        raise ReceiptProcessingError("No valid image files provided.")
 
-    # OCR 수행
+    # 이전에 OCR한 이미지는 캐시된 결과 사용
     extracted_texts = {}
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        future_to_image = {
-            executor.submit(perform_ocr, ocr_api_url, secret_key, image_info, session): image_info
-            for image_info in valid_image_paths
+    cache_keys = {}
+    pending_images = []
+    for image_info in valid_images:
+        image_type, image_data = image_info
+        cache_key = _image_cache_key(image_data)
+        cached_text = ocr_cache.get(cache_key)
+        if cached_text is None:
+            cache_keys[image_type] = cache_key
+            pending_images.append(image_info)
+        else:
+            logger.info(f"OCR cache hit for: {image_type}")
+            extracted_texts[image_type] = cached_text
+
+    # 전처리는 GIL 영향을 받지 않도록 프로세스 풀에서, OCR 요청은 스레드 풀에서 수행
+    process_pool, thread_pool = _get_pools()
+    if pending_images and not _summary_connection_is_warm():
+        # OCR이 진행되는 동안 요약 API 연결을 미리 열어 요약 요청 시 핸드셰이크 생략
+        # OCR 스레드 풀 슬롯을 차지하지 않도록 별도 스레드에서 수행
+        threading.Thread(target=prewarm_connection, args=(OPENAI_API_URL, _session), daemon=True).start()
+    if PREPROCESS_ENABLED:
+        preprocess_futures = {
+            process_pool.submit(preprocess_and_encode, image_info): image_info[0]
+            for image_info in pending_images
         }
-        for future in as_completed(future_to_image):
-            image_type, text = future.result()
-            extracted_texts[image_type] = text
-
-    # OCR 결과 결합
-    combined_text = "\n".join(extracted_texts.values())
-    if not combined_text.strip():
+        ocr_futures = []
+    else:
+        # 전처리 없이 원본 바이트를 원본 형식 그대로 업로드
+        preprocess_futures = {}
+        ocr_futures = [
+            thread_pool.submit(
+                perform_ocr, OCR_API_URL, OCR_SECRET_KEY, image_type, image_data, _session, image_formats[image_type]
+            )
+            for image_type, image_data in pending_images
+        ]
+    for future in as_completed(preprocess_futures):
+        try:
+            image_type, image_buffer = future.result()
+        except BrokenProcessPool:
+            # 이번 이미지는 실패 처리하고, 다음 요청에서 _get_pools가 풀을 새로 생성
+            image_type, image_buffer = preprocess_futures[future], None
+            logger.error(f"Preprocessing worker terminated abruptly for: {image_type}")
+        if image_buffer is None:
+            extracted_texts[image_type] = ""
+            continue
+        ocr_futures.append(
+            thread_pool.submit(perform_ocr, OCR_API_URL, OCR_SECRET_KEY, image_type, image_buffer, _session)
+        )
+    for future in as_completed(ocr_futures):
+        image_type, text = future.result()
+        extracted_texts[image_type] = text
+        if text:
+            ocr_cache[cache_keys[image_type]] = text
+
+    # OCR 결과 확인
+    if not any(text.strip() for text in extracted_texts.values()):
         logger.error("OCR result is empty.")
-        sys.exit(1)
+        raise ReceiptProcessingError("OCR result is empty.")
 
-    # 프롬프트 설정
-    prompt = f"""
-    다음은 상품 목록과 관련된 데이터로, '[상품명] [단가] [수량] [금액]'으로 구성되어 있습니다.
-    각 항목별로 번호를 매기고, **상품명과 총액(단가 * 수량)**만 아래와 같은 형식으로 정리해주세요:
-
-    0: [상품명] $[총액]
-    1: [상품명] $[총액]
-    ...
-
-    입력 데이터:
-    {combined_text}
-    """
+    # 프롬프트 설정 (OCR 결과를 중간 문자열 없이 한 번에 결합)
+    prompt = "\n".join([SUMMARY_PROMPT_HEADER, *extracted_texts.values()])
 
     # 요약 요청
-    summary_result = perform_summarization(openai_api_url, openai_api_key, prompt, session)
+    summary_result = perform_summarization(OPENAI_API_URL, OPENAI_API_KEY, prompt, _session, on_delta=on_delta)
 
-    # 결과 출력
-    if summary_result:
-        print(summary_result)
-    else:
+    if not summary_result:
         logger.error("Failed to retrieve summary result.")
+        raise ReceiptProcessingError("Failed to retrieve summary result.")
+    return summary_result
+
+def main(*image_paths):
+    """
+    CLI 실행 시 요약 결과를 생성되는 대로 출력
+    """
+    try:
+        process_images(load_images(image_paths), on_delta=lambda text: print(text, end='', flush=True))
+    except ReceiptProcessingError:
         sys.exit(1)
+    print()
 
 if __name__ == '__main__':
     image_file_paths = sys.argv[1:]